@@ -3,10 +3,22 @@ import sys
 import zipfile
 import json
 import re
-from collections import defaultdict
+import heapq
+import mmap
+import struct
+import tempfile
+import zlib
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, repeat
+
+try:
+    import orjson  # much faster parsing/serialization when available
+except ImportError:
+    orjson = None
 
 # Define the modid whitelist here
-MODID_WHITELIST = {
+MODID_WHITELIST = frozenset({
     "minecraft",  # always include vanilla
     "create",
     "mekanism",
@@ -14,57 +26,221 @@ MODID_WHITELIST = {
     "modern_industrialization",
     "minecolonies",
     # add more modids as needed
-}
+})
 
+# data/<namespace>/recipes/<path>.json (or recipe/ on newer versions)
+_RECIPE_RE = re.compile(r'^data/([^/]+)/recipes?/(.+)\.json$')
+# Most shard files open at once while merging; keeps well under the usual
+# open-file limits (256 on macOS) however many jars there are
+MERGE_FAN_IN = 64
 
-def detect_modid_from_toml(toml_content):
-    # Attempt to extract modid from mods.toml content (simple regex)
-    match = re.search(r'id\s*=\s*"([^"]+)"', toml_content)
-    if match:
-        return match.group(1)
-    return None
 
-def get_modid_from_jar(jar_path):
-    try:
-        with zipfile.ZipFile(jar_path, 'r') as z:
-            # Check for mods.toml or neoforge.mods.toml
-            for toml_path in ['META-INF/mods.toml', 'META-INF/neoforge.mods.toml']:
-                try:
-                    with z.open(toml_path) as f:
-                        content = f.read().decode('utf-8')
-                        modid = detect_modid_from_toml(content)
-                        if modid:
-                            return modid
-                except KeyError:
-                    continue
-        # fallback: modid = jar filename before first dash or underscore
-        filename = os.path.basename(jar_path)
-        name_without_ext = os.path.splitext(filename)[0]
-        fallback_modid = name_without_ext.lower()
-        return fallback_modid
-    except Exception as e:
-        print(f"Warning: Could not get modid for {jar_path}: {e}")
-        return None
+def loads_json(data):
+    if orjson is not None:
+        # orjson rejects a UTF-8 BOM, which json.loads on bytes accepts
+        if data[:3] == b'\xef\xbb\xbf':
+            data = data[3:]
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps_json(obj, pretty=True):
+    # UTF-8 encoded bytes, indented unless pretty is False
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, indent=2).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def _shard_key(line):
+    # Shard lines are <json output id>\t<json recipe>\n
+    return line[:line.index(b'\t')]
 
-def get_all_recipe_files(zip_file):
-    # Matches any path like data/*/recipes/*.json or data/*/recipe/*.json
-    return [
-        f for f in zip_file.namelist()
-        if f.startswith("data/") and "/recipe" in f and f.endswith(".json")
+def write_shard(extract, jar_path, shard_path):
+    # Run one extractor and spill its (output_id, recipe) pairs to disk,
+    # sorted by output id, so the worker can free them straight away
+    lines = [
+        dumps_json(out_id, pretty=False) + b'\t' + dumps_json(recipe, pretty=False) + b'\n'
+        for out_id, recipe in extract(jar_path)
     ]
+    if not lines:
+        return None
+    lines.sort(key=_shard_key)
+    with open(shard_path, 'wb') as f:
+        f.writelines(lines)
+    return shard_path
+
+def reduce_shards(shard_paths):
+    # Merge consecutive groups of at most MERGE_FAN_IN sorted shards into
+    # intermediate shards (next to the inputs, which are removed) until few
+    # enough remain to open at once. Consecutive groups keep the jar order
+    # for equal output ids.
+    level = 0
+    while len(shard_paths) > MERGE_FAN_IN:
+        merged_paths = []
+        for i in range(0, len(shard_paths), MERGE_FAN_IN):
+            group = shard_paths[i:i + MERGE_FAN_IN]
+            path = os.path.join(os.path.dirname(group[0]), f"merge{level}_{i}.jsonl")
+            with ExitStack() as stack:
+                shards = [stack.enter_context(open(p, 'rb')) for p in group]
+                with open(path, 'wb') as out:
+                    out.writelines(heapq.merge(*shards, key=_shard_key))
+            for p in group:
+                os.remove(p)
+            merged_paths.append(path)
+        shard_paths = merged_paths
+        level += 1
+    return shard_paths
+
+def write_merged_shards(shard_paths, f, pretty=False):
+    # k-way merge of the sorted shards, writing one output id at a time.
+    # Shards are merged in the order given, so for each output id the
+    # recipes keep that jar order. Compact output copies the recipe bytes
+    # from the shards as-is; only pretty output re-parses them. Returns the
+    # number of output ids.
+    shard_paths = reduce_shards(shard_paths)
+    count = 0
+    with ExitStack() as stack:
+        shards = [stack.enter_context(open(p, 'rb')) for p in shard_paths]
+        f.write(b'{')
+        sep = b'\n' if pretty else b''
+        for out_id, lines in groupby(heapq.merge(*shards, key=_shard_key), key=_shard_key):
+            start = len(out_id) + 1
+            f.write(sep)
+            if pretty:
+                recipes = [loads_json(line[start:]) for line in lines]
+                f.write(b'  ' + out_id + b': ')
+                f.write(dumps_json(recipes).replace(b'\n', b'\n  '))
+                sep = b',\n'
+            else:
+                f.write(out_id + b':[' + b','.join(line[start:-1] for line in lines) + b']')
+                sep = b','
+            count += 1
+        f.write(b'\n}' if pretty and count else b'}')
+    return count
+
+class _MappedJar(mmap.mmap):
+    # zipfile checks seekable() when handing out ZipExtFile objects, which
+    # mmap only grew in Python 3.13
+    def seekable(self):
+        return True
+
+    def seek(self, *args):
+        # zipfile only expects OSError from a bad seek (e.g. while looking
+        # for the end record of a non-zip file); mmap raises ValueError
+        try:
+            return super().seek(*args)
+        except ValueError as e:
+            raise OSError(str(e)) from e
+
+@contextmanager
+def open_jar(jar_path):
+    # Map the jar into memory so central directory and entry reads are
+    # copies out of the page cache rather than individual read() calls
+    with open(jar_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # An empty file can't be mapped; let zipfile reject it as usual
+            with zipfile.ZipFile(f, 'r') as z:
+                yield z
+            return
+        mm = _MappedJar(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with zipfile.ZipFile(mm, 'r') as z:
+                yield z
+        finally:
+            mm.close()
+
+def iter_zip_entries(z, names):
+    # Walk the requested entries in on-disk order, reading each local header
+    # and payload straight from the archive file. This keeps reads moving
+    # forward and skips the per-entry ZipExtFile setup of z.open().
+    # Yields (zi, data, error); a damaged entry comes back with its error so
+    # the caller can report it and carry on with the rest of the jar.
+    infos = sorted((z.getinfo(n) for n in names), key=lambda zi: zi.header_offset)
+    fp = z.fp
+    for zi in infos:
+        if zi.file_size == 0:
+            continue
+        fp.seek(zi.header_offset)
+        header = fp.read(30)
+        if len(header) != 30 or header[:4] != b'PK\x03\x04':
+            yield zi, None, zipfile.BadZipFile(f"Bad local file header for {zi.filename}")
+            continue
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        fp.seek(name_len + extra_len, os.SEEK_CUR)
+        yield zi, fp.read(zi.compress_size), None
+
+def decompress_entry(z, zi, data):
+    if zi.flag_bits & 0x1:
+        # Encrypted; let zipfile deal with it
+        return z.read(zi)
+    if zi.compress_type == zipfile.ZIP_STORED:
+        pass
+    elif zi.compress_type == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -15)
+    else:
+        return z.read(zi)
+    if zlib.crc32(data) != zi.CRC:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file {zi.filename!r}")
+    return data
+
+def load_recipes(z, names):
+    # Yields (name, recipe_json, error) in archive order
+    for zi, data, error in iter_zip_entries(z, names):
+        if error is not None:
+            yield zi.filename, None, error
+            continue
+        try:
+            recipe_json = loads_json(decompress_entry(z, zi, data))
+        except Exception as e:
+            yield zi.filename, None, e
+            continue
+        yield zi.filename, recipe_json, None
+
+def is_whitelisted(modid, whitelist):
+    # A modid counts if any whitelisted id is part of it, so addons such as
+    # mekanismgenerators or createaddition come along with their base mod
+    normalized_modid = modid.replace('-', '_')
+    return any(whitelisted in normalized_modid for whitelisted in whitelist)
+
+def get_all_recipe_files(zip_file, whitelist=None):
+    # Matches any path like data/*/recipes/*.json or data/*/recipe/*.json,
+    # optionally only for namespaces that pass is_whitelisted. Anchoring on
+    # the directory keeps advancements/recipes/ etc. from being parsed only
+    # to be thrown away.
+    match = _RECIPE_RE.match
+    allowed = {}
+    recipe_files = []
+    for f in zip_file.namelist():
+        m = match(f)
+        if not m:
+            continue
+        if whitelist is not None:
+            ns = m.group(1)
+            if ns not in allowed:
+                allowed[ns] = is_whitelisted(ns, whitelist)
+            if not allowed[ns]:
+                continue
+        recipe_files.append(f)
+    return recipe_files
 
 def extract_output_ids(recipe_json):
     outputs = []
+    if not isinstance(recipe_json, dict):
+        return outputs
+
+    # Look each top-level key up once instead of testing and then indexing
+    result = recipe_json.get('result')
+    results = recipe_json.get('results')
 
     # Handle standard Minecraft crafting result
-    if 'result' in recipe_json and isinstance(recipe_json['result'], dict):
-        rid = recipe_json['result'].get('id') or recipe_json['result'].get('item')
+    if isinstance(result, dict):
+        rid = result.get('id') or result.get('item')
         if rid:
             outputs.append(rid)
 
     # Create-style multi-output format
-    elif 'results' in recipe_json and isinstance(recipe_json['results'], list):
-        for r in recipe_json['results']:
+    elif isinstance(results, list):
+        for r in results:
             rid = r.get('id') or r.get('item')
             if rid:
                 outputs.append(rid)
@@ -87,32 +263,32 @@ def extract_output_ids(recipe_json):
             elif isinstance(out, str):
                 outputs.append(out)
 
-    # Deduplicate & ensure strings
-    return list(set(o for o in outputs if isinstance(o, str)))
+    # Deduplicate (keeping first-seen order) & ensure strings
+    return list(dict.fromkeys(o for o in outputs if isinstance(o, str)))
 
 
 def extract_recipes_from_zip(jar_path, modid_filter=None):
-    recipes = {}
+    # Returns (output_id, recipe_json) pairs; a recipe with several outputs
+    # appears once per output id
+    recipes = []
+    whitelist = MODID_WHITELIST if modid_filter is None else modid_filter
     try:
-        with zipfile.ZipFile(jar_path, 'r') as z:
-            modid = get_modid_from_jar(jar_path)
-            if not modid:
-                print(f"Could not detect modid for jar {jar_path}")
+        with open_jar(jar_path) as z:
+            # The recipe namespaces are the modids we care about, so filter
+            # on them directly instead of detecting the jar's own modid.
+            # This also picks up whitelisted namespaces a jar bundles for
+            # other mods (e.g. minecraft: overrides).
+            recipe_files = get_all_recipe_files(z, whitelist)
+            jar_name = os.path.basename(jar_path)
+            if not recipe_files:
+                print(f"Skipping mod jar '{jar_name}' (no whitelisted recipe namespaces)")
                 return recipes
-            normalized_modid = modid.replace('-', '_')
-            if not any(whitelisted in normalized_modid for whitelisted in MODID_WHITELIST):
-                print(f"Skipping mod '{modid}' (not in whitelist)")
-                return recipes
-            print(f"Extracting recipes from mod jar '{os.path.basename(jar_path)}' modid(s): {modid}")
-
-            recipe_files = get_all_recipe_files(z)
-            print(f"Found {len(recipe_files)} recipe files in '{modid}'")
-            for rf in recipe_files:
-                try:
-                    with z.open(rf) as f:
-                        recipe_json = json.load(f)
-                except Exception as e:
-                    print(f"Error reading recipe {rf} in {jar_path}: {e}")
+            modids = sorted({rf.split('/', 2)[1] for rf in recipe_files})
+            print(f"Extracting recipes from mod jar '{jar_name}' modid(s): {', '.join(modids)}")
+            print(f"Found {len(recipe_files)} recipe files in '{jar_name}'")
+            for rf, recipe_json, error in load_recipes(z, recipe_files):
+                if error is not None:
+                    print(f"Error reading recipe {rf} in {jar_path}: {error}")
                     continue
                 output_ids = extract_output_ids(recipe_json)
                 if not output_ids:
@@ -123,27 +299,21 @@ def extract_recipes_from_zip(jar_path, modid_filter=None):
                     if isinstance(out_id, dict):
                         continue
                     # Store the full recipe json keyed by output id
-                    # If multiple recipes produce same output, store as list
-                    if out_id not in recipes:
-                        recipes[out_id] = []
-                    recipes[out_id].append(recipe_json)
+                    recipes.append((out_id, recipe_json))
     except Exception as e:
         print(f"Error opening jar {jar_path}: {e}")
     return recipes
 
 def extract_vanilla_recipes_from_jar(jar_path):
-    recipes = {}
+    recipes = []
     try:
-        with zipfile.ZipFile(jar_path, 'r') as z:
+        with open_jar(jar_path) as z:
             prefix = "data/minecraft/recipes/"
             recipe_files = [f for f in z.namelist() if f.startswith(prefix) and f.endswith('.json')]
             print(f"Extracting vanilla recipes from {len(recipe_files)} files")
-            for rf in recipe_files:
-                try:
-                    with z.open(rf) as f:
-                        recipe_json = json.load(f)
-                except Exception as e:
-                    print(f"Error reading vanilla recipe {rf}: {e}")
+            for rf, recipe_json, error in load_recipes(z, recipe_files):
+                if error is not None:
+                    print(f"Error reading vanilla recipe {rf}: {error}")
                     continue
                 output_ids = extract_output_ids(recipe_json)
                 if not output_ids:
@@ -151,49 +321,47 @@ def extract_vanilla_recipes_from_jar(jar_path):
                 for out_id in output_ids:
                     if isinstance(out_id, dict):
                         continue
-                    if out_id not in recipes:
-                        recipes[out_id] = []
-                    recipes[out_id].append(recipe_json)
+                    recipes.append((out_id, recipe_json))
     except Exception as e:
         print(f"Error opening vanilla jar {jar_path}: {e}")
     return recipes
 
-def merge_recipe_dicts(dicts):
-    merged = defaultdict(list)
-    for d in dicts:
-        for k, v in d.items():
-            merged[k].extend(v)
-    return dict(merged)
-
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python merge_recipes.py <mods_folder_path> <minecraft_jar_path>")
+    args = sys.argv[1:]
+    # Output is compact JSON unless --pretty asks for 2-space indentation
+    pretty = '--pretty' in args
+    if pretty:
+        args.remove('--pretty')
+    if len(args) != 2:
+        print("Usage: python merge_recipes.py [--pretty] <mods_folder_path> <minecraft_jar_path>")
         return
 
-    mods_folder = sys.argv[1]
-    minecraft_jar_path = sys.argv[2]
+    mods_folder = args[0]
+    minecraft_jar_path = args[1]
 
-    all_mod_recipes = []
-    mod_jars = [os.path.join(mods_folder, f) for f in os.listdir(mods_folder) if f.endswith('.jar')]
+    with os.scandir(mods_folder) as it:
+        mod_jars = [e.path for e in it if e.name.endswith('.jar') and e.is_file()]
 
     print(f"Found {len(mod_jars)} mod jars to process...")
 
-    for jar_path in mod_jars:
-        mod_recipes = extract_recipes_from_zip(jar_path)
-        if mod_recipes:
-            all_mod_recipes.append(mod_recipes)
-
-    vanilla_recipes = extract_vanilla_recipes_from_jar(minecraft_jar_path)
-    if vanilla_recipes:
-        all_mod_recipes.append(vanilla_recipes)
-
-    merged = merge_recipe_dicts(all_mod_recipes)
-    print(f"Total unique output items with recipes collected: {len(merged)}")
-
     out_path = "merged_recipes.json"
-    with open(out_path, 'w', encoding='utf-8') as f:
-        json.dump(merged, f, indent=2)
+    with tempfile.TemporaryDirectory() as shard_dir:
+        # Each jar is independent, so fan the extraction out across CPU cores.
+        # Workers write their recipes to per-jar shards instead of sending
+        # them back, and the shards are merged straight into the output.
+        mod_shards = [os.path.join(shard_dir, f"{i}.jsonl") for i in range(len(mod_jars))]
+        vanilla_shard = os.path.join(shard_dir, "vanilla.jsonl")
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+            vanilla_future = ex.submit(write_shard, extract_vanilla_recipes_from_jar,
+                                       minecraft_jar_path, vanilla_shard)
+            shard_paths = list(ex.map(write_shard, repeat(extract_recipes_from_zip),
+                                      mod_jars, mod_shards, chunksize=4))
+            shard_paths.append(vanilla_future.result())
+
+        with open(out_path, 'wb') as f:
+            count = write_merged_shards([p for p in shard_paths if p], f, pretty)
 
+    print(f"Total unique output items with recipes collected: {count}")
     print(f"Saved merged recipes to {out_path}")
 
 if __name__ == "__main__":